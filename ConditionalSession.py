@@ -0,0 +1,31 @@
+import requests
+
+
+class ConditionalSession(requests.Session):
+    """
+    requests Session that revalidates repeat GETs using the ETag/Last-Modified headers of the
+    previous response, and hands that response back again when the server answers 304 Not Modified.
+    """
+    def __init__(self):
+        super().__init__()
+        self.cache = {}
+        self.not_modified = False
+
+    def get(self, url, params=None, headers=None, **kwargs):
+        key = requests.Request('GET', url, params=params).prepare().url
+        cached = self.cache.get(key)
+        headers = dict(headers or {})
+        if cached is not None:
+            if 'ETag' in cached.headers:
+                headers['If-None-Match'] = cached.headers['ETag']
+            if 'Last-Modified' in cached.headers:
+                headers['If-Modified-Since'] = cached.headers['Last-Modified']
+
+        resp = super().get(url, params=params, headers=headers, **kwargs)
+
+        self.not_modified = cached is not None and resp.status_code == 304
+        if self.not_modified:
+            return cached
+        if resp.status_code == 200 and ('ETag' in resp.headers or 'Last-Modified' in resp.headers):
+            self.cache[key] = resp
+        return resp
@@ -18,6 +18,9 @@
 #       # sudo pip3 install scrollphat
 # 	# curl https://get.pimoroni.com/scrollphathd | bash
 #    * The scrollphat requires I2C enabled. Make sure that is turned on in raspi-config if the install above doesn't enable it.
+#    * Optional, but recommended: raise the I2C bus speed from the default 100kHz so that display updates take less time. Add this
+#	line to /boot/config.txt and reboot (a warning is logged at startup if the bus is still running at 100kHz):
+#	dtparam=i2c_baudrate=400000
 #    * You will need an OpenWeather API key, available for free at https://openweathermap.org. You just need a free "Current Weather Data" subscription, not one of the paid ones, though you're welcome to support them.
 #    * export OWM_API_KEY with your API key in your .bashrc (export OWM_API_KEY <OWM API key value>)
 #
@@ -31,17 +34,27 @@
 
 import scrollphathd #default scrollphathd library
 from scrollphathd.fonts import font3x5
+import numpy
+try:
+	from smbus2 import i2c_msg	#used to send a whole frame to the display in one I2C transaction
+except ImportError:
+	i2c_msg = None
 #from pyowm.owm import OWM	# OpenWeather library
 import pyowm
 import time	#returns time values
 import os
 import sys
-import getopt
 import logging
-import urllib3
-import socket
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import threading
+import queue
+import json
+from collections import deque
+from dataclasses import dataclass, field
 from StreamToLogger import StreamToLogger
+from ConditionalSession import ConditionalSession
 
 from secrets import OWM_API_KEY
 
@@ -55,39 +68,59 @@ sys.stderr = StreamToLogger(log, logging.ERROR)
 USAGE = f"Usage: python3 {sys.argv[0]} [-h|--help] | [-v|--version] | [-d|--debug]"
 VERSION = f"{sys.argv[0]} version 1.0.0"
 
-# Debug flag  - set to 1 if you want to print(informative console messages)
-DEBUG = 0
-
+# Only three flags are supported, so check them by hand rather than importing getopt/argparse at startup
+#	-d/--debug turns on the log.debug() messages and echoes the log to the console as well
 def parse():
-	global DEBUG
-
-	options, arguments = getopt.getopt(
-		sys.argv[1:],			# Arguments
-		'vhd',				# Short option definitions
-		["version", "help", "debug"])	# Long option definitions
-	for o, a in options:
-		if o in ("-v", "--version"):
+	for arg in sys.argv[1:]:
+		if arg in ("-v", "--version"):
 			print(VERSION)
 			sys.exit()
-		if o in ("-h", "--help"):
+		elif arg in ("-h", "--help"):
 			print(USAGE)
 			sys.exit()
-		if o in ("-d", "--debug"):
-			DEBUG = 1
-	if len(arguments) > 1:
-		raise SystemExit(USAGE)
-	try:
-		operands = [int(arg) for arg in arguments]
-	except ValueError:
-		raise SystemExit(USAGE)
-	return operands
+		elif arg in ("-d", "--debug"):
+			console = logging.StreamHandler(sys.stdout)
+			console.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+			log.addHandler(console)
+			log.setLevel(logging.DEBUG)
+		else:
+			raise SystemExit(USAGE)
 
-operands = parse()
+parse()
 
 # Uncomment the below if your display is upside down
 #   (e.g. if you're using it in a Pimoroni Scroll Bot)
 scrollphathd.rotate(degrees=180)
 
+# Where the kernel exposes the I2C bus speed (in Hz, as a big-endian 32 bit value)
+I2C_CLOCK_FREQUENCY_FILE = "/sys/class/i2c-adapter/i2c-1/of_node/clock-frequency"
+
+#
+# setup_display() - Initializes the scrollphathd and speeds up sending frames to it.
+#	scrollphathd sends each 144 byte frame as a series of 32 byte SMBus block writes, each of which repeats the start
+#	condition, device address and register. The display's controller (an IS31FL3731) auto-increments its register
+#	pointer, so when the I2C bus supports it we replace that with a single i2c_rdwr() write of the whole frame.
+#
+
+def setup_display():
+	scrollphathd.setup()
+	display = scrollphathd.display
+	if i2c_msg is not None and hasattr(display.i2c, "i2c_rdwr"):
+		color_offset = scrollphathd.is31fl3731._COLOR_OFFSET
+		def update_frame(frame):
+			display.set_bank(frame)
+			display.i2c.i2c_rdwr(i2c_msg.write(display.address, [color_offset] + display._buf[frame]))
+		display.update_frame = update_frame
+
+	try:
+		with open(I2C_CLOCK_FREQUENCY_FILE, "rb") as f:
+			clock_frequency = int.from_bytes(f.read(), "big")
+	except OSError: #not running on a Pi, or the bus speed isn't exposed
+		return;
+	if clock_frequency <= 100000:
+		log.warning("I2C bus is running at %d Hz; add dtparam=i2c_baudrate=400000 to /boot/config.txt for faster display updates", clock_frequency)
+	return;
+
 # OpenWeather API key
 OWM_API_KEY = os.environ.get("OWM_API_KEY", OWM_API_KEY) #or set the OWM_API_KEY environment variable
 
@@ -99,6 +132,18 @@ except pyowm.commons.exceptions.UnauthorizedError as e:
 	e.msg = "{} (Did you set the API key?)".format(e.msg)
 	raise (e)
 
+# Revalidate the observation instead of downloading it again on every poll. OWM only refreshes its data roughly every
+#	10 minutes, so most polls come back as an empty 304 Not Modified and the previous response is reused.
+#	Sharing one session also keeps the connection to the API server alive between polls.
+# Only one request is ever in flight, so a single pooled connection is enough. The server often closes that connection
+#	while it sits idle between polls; the adapter retries once straight away on a fresh connection rather than letting
+#	that count as a failed fetch. Real outages are still left to the backoff in fetch_observation().
+owm_session = ConditionalSession()
+owm_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=Retry(total=1, status=0, backoff_factor=0))
+owm_session.mount("https://", owm_adapter)
+owm_session.mount("http://", owm_adapter)
+weather_mgr.http_client.http = owm_session
+
 # Customize this for your desired location. Easiest way to figure it out is to do a wunderground location search and copy/paste the tail end of the URL
 #	Note that some locations are a bit wonky. If a specific location has a hypen "-" in it and it doesn't work, try substituting an underscore "_" instead
 #	Even then, I couldn't get some locations to work properly. Seems like a possible bug in the wunderground API.
@@ -121,8 +166,17 @@ OWM_STATION = os.environ.get("OWM_STATION", OWM_STATION)
 # Weather polling interval (seconds). Free Wunderground API accounts allow 500 calls/day, so min interval of 172 (every ~2.88 min), assuming you're only making 1 call at a time.
 POLL_INTERVAL = 180
 
-# Interval after which the average temp is reset. Used to make sure that the temp trending indicator stays accurate. Default is 60 min.
+# Period (in minutes) the average temp is taken over. The trending indicator compares the current temp against the average of the readings
+#	from the last AVG_TEMP_RESET_INTERVAL minutes. Default is 60 min.
 AVG_TEMP_RESET_INTERVAL = 60
+TEMP_HISTORY_LENGTH = AVG_TEMP_RESET_INTERVAL * 60 // POLL_INTERVAL #number of readings in the averaging window
+# The average is a running sum that picks up floating point error as readings come and go, so a current temp within this
+#	many degrees of it counts as the same (no arrow) rather than needing to match exactly.
+TEMP_TREND_TOLERANCE = 1e-6
+
+# The recent temperature readings are saved here after every poll and reloaded at startup, so that the trending indicator
+#	is meaningful straight away after a restart. Or set the WEATHERBOT_STATE_FILE environment variable.
+STATE_FILE = os.environ.get("WEATHERBOT_STATE_FILE", "/var/lib/weatherbot/state.json")
 
 # Flags used to specify whether to display actual or "feels like" temperature.
 # Change CURRENT_TEMP_DISPLAY to 1 for actual temp and anything other than 1 for feels like temperature
@@ -151,92 +205,151 @@ if TEMP_SCALE == "F": #set max wind speed according to scale
 else:
 	MAX_WIND_SPEED = 100.0 #KPH; default 100.0
 	UNITS="celsius"
+WIND_MULTIPLIER = 17.0 / MAX_WIND_SPEED
 
-#Initialize global variables before use
-current_temp = 0.0
-average_temp = 0.0
-wind_chill = 0.0
-average_temp_counter = 0
-average_temp_cumulative = 0.0
-total_poll_time = 0 #used to reset the average temp after a defined amount of time has passed
-wind_speed = 0.0
-wind_gusts = 0
-actual_str = " "
-feels_like_str = " "
-feels_like = 0
-
-#
-# get_weather_data() - Retrieves and parses the weather data we want to display from Wunderground. Returns a formatted temperature string
-#	using the specified scale. To request a free API key, go here: https://www.wunderground.com/weather/api/d/pricing.html
-#
-
-def get_weather_data():
-	# Make sure that the module updates the global variables instead of creating local copies
-	global current_temp
-	global average_temp_cumulative
-
-	global average_temp_counter
-	global average_temp
-	global wind_speed
-	global wind_gusts
-	global current_str
-	global actual_str
-	global feels_like_str
-	global feels_like
-
-	#Get current conditions. Substitute your personal Wunderground API key and the desired weather station code
+#
+# WeatherState - the latest weather readings, plus the recent temperature readings used to work out the average temperature
+#	for the trend indicator. A single instance is created at startup and passed to the functions that update or draw it.
+#	temp_history_sum is kept up to date as readings enter and leave temp_history, so the average never has to re-add them all.
+#
+@dataclass
+class WeatherState:
+	current_temp: float = 0.0
+	feels_like: float = 0.0
+	average_temp: float = 0.0
+	temp_history: deque = field(default_factory=lambda: deque(maxlen=TEMP_HISTORY_LENGTH))
+	temp_history_sum: float = 0.0
+	wind_speed: float = 0.0
+	wind_gusts: float = 0.0
+	actual_str: str = " "
+	feels_like_str: str = " "
+
+# Retry settings used when OWM can't be reached. Each failed attempt doubles the wait before the next one (1s, 2s, 4s, ...),
+#	capped at MAX_RETRY_DELAY seconds. After FETCH_ATTEMPTS failures the poll is skipped and the display keeps showing the
+#	last good reading until the next poll comes around.
+FETCH_ATTEMPTS = 3
+MAX_RETRY_DELAY = 60
+
+#
+# add_temp_reading(state, temp) - Adds a temperature reading to the averaging window, dropping the oldest one once the window
+#	is full, and updates the average temp.
+#
+
+def add_temp_reading(state, temp):
+	if len(state.temp_history) == state.temp_history.maxlen:
+		state.temp_history_sum -= state.temp_history[0] #about to be pushed out by the append below
+	state.temp_history.append(temp)
+	state.temp_history_sum += temp
+	state.average_temp = state.temp_history_sum / len(state.temp_history)
+	return;
+
+#
+# load_temp_history(state) / save_temp_history(state) - Reload and save the averaging window in STATE_FILE. Readings saved
+#	longer ago than the averaging period are ignored, since they no longer say anything about the current trend, as are
+#	readings saved under a different TEMP_SCALE.
+#
+
+def load_temp_history(state):
+	try:
+		with open(STATE_FILE) as f:
+			saved = json.load(f)
+		if time.time() - saved["saved"] > AVG_TEMP_RESET_INTERVAL * 60 or saved["scale"] != TEMP_SCALE:
+			return;
+		temps = [float(temp) for temp in saved["temps"]] #check them all before adding any
+	except FileNotFoundError:
+		return;
+	except (OSError, ValueError, KeyError, TypeError) as e: #unreadable, not JSON, or not laid out the way save_temp_history() writes it
+		log.warning("Couldn't read temperature history from %s: %s", STATE_FILE, e)
+		return;
+	for temp in temps:
+		add_temp_reading(state, temp)
+	return;
+
+def save_temp_history(state):
+	try:
+		os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
+		with open(STATE_FILE + ".tmp", "w") as f:
+			json.dump({"saved": time.time(), "scale": TEMP_SCALE, "temps": list(state.temp_history)}, f)
+		os.replace(STATE_FILE + ".tmp", STATE_FILE) #so a power cut mid-write can't leave a truncated file behind
+	except OSError as e:
+		log.warning("Couldn't save temperature history to %s: %s", STATE_FILE, e)
+	return;
+
+#
+# fetch_observation() - Fetches the current observation from OWM, backing off exponentially between attempts.
+#	Returns the weather observation, or None if OWM couldn't be reached this time around. Only network and server errors are
+#	retried; anything else (a bad API key, an unknown station, Ctrl-C) is raised straight away.
+#
+
+def fetch_observation():
 	trycount = 0
+	delay = 1
 	obs = None
-	while obs is None and trycount < 10:
+	while obs is None and trycount < FETCH_ATTEMPTS:
 		try:
 			obs = weather_mgr.weather_at_place(OWM_STATION).weather
-		except (urllib3.exceptions.ReadTimeoutError, socket.timeout, requests.exceptions.ReadTimeout, pyowm.commons.exceptions.TimeoutError):
-			print("TIMEOUT ERROR: ", sys.exc_info()[0])
+		except (requests.RequestException, pyowm.commons.exceptions.APIRequestError, pyowm.commons.exceptions.ParseAPIResponseError) as e:
+			log.warning("OWM fetch failed: %s", e)
 			trycount += 1
-			time.sleep(10)
-		except:
-			print("OTHER ERROR: ", sys.exc_info()[0])
-			trycount += 1
-			time.sleep(10)
-	if trycount > 0:
-		print(f'Took {trycount} retries to get weather.')
+		if obs is None and trycount < FETCH_ATTEMPTS:
+			time.sleep(delay)
+			delay = min(delay * 2, MAX_RETRY_DELAY)
+	if obs is None:
+		log.warning("Giving up on weather after %d tries; will try again next poll", trycount)
+	elif trycount > 0:
+		log.info("Took %d retries to get weather", trycount)
+	if owm_session.not_modified:
+		log.debug("Observation not modified since last poll")
+	return obs
 
-	#build current temperature string
+#
+# poll_weather() - Runs on a background thread, fetching a new observation every POLL_INTERVAL seconds and handing it to
+#	the display loop through the _observations queue. Keeping the network I/O here means a slow or failing fetch never
+#	freezes the KR pulse. If fetch_observation() raises, the thread ends (the traceback goes to the log) and the display
+#	loop exits rather than carrying on with a reading that will never be updated.
+#
+
+_observations = queue.Queue(maxsize=1)
 
-	# Check to see if average temp counters need to be reset
-	if (average_temp_counter * POLL_INTERVAL / 60) > AVG_TEMP_RESET_INTERVAL:
-		average_temp_cumulative = 0.0
-		average_temp_counter = 0
-		if DEBUG:
-			print("Resetting average temp counters")
+def poll_weather():
+	while True:
+		# Schedule against the monotonic clock so that slow fetches and wall clock changes (NTP, DST) don't shift the polls
+		next_poll = time.monotonic() + POLL_INTERVAL
+		obs = fetch_observation()
+		if obs is not None: #if OWM couldn't be reached, the display keeps showing the last reading until the next poll
+			_observations.put(obs)
+		time.sleep(max(0.0, next_poll - time.monotonic()))
+
+#
+# get_weather_data(state, obs) - Parses the weather data we want to display out of an OpenWeatherMap observation, updating
+#	the temperature and wind values in state.
+#
+
+def get_weather_data(state, obs):
+	#build current temperature string
 
 	# parse out the current temperature and wind speeds from the json catalog based on which temperature scale is being used
 	temp = obs.temperature(UNITS)
-	temperature = str(temp['temp']) 	#string used for display purposes
-	current_temp = float(temp['temp'])		#string used for calculations
-	feels_like = float(temp['feels_like'])
+	state.current_temp = float(temp['temp'])
+	state.feels_like = float(temp['feels_like'])
 
 	wind = obs.wind(unit='miles_hour')
-	wind_speed = float(wind.get('speed',0.0))
-	wind_gusts = float(wind.get('gust',0.0))
+	state.wind_speed = float(wind.get('speed',0.0))
+	state.wind_gusts = float(wind.get('gust',0.0))
 	
 	# Calculate average temperature, which is used to determine temperature trending (same, up, down)
-	average_temp_cumulative = average_temp_cumulative + current_temp
-	average_temp_counter = average_temp_counter + 1
-	average_temp = average_temp_cumulative / average_temp_counter
-	fl_int = int(feels_like) #convert to integer from float. For some reason you can't cast the above directly as an int, so need to take an extra step. I'm sure there is a more elegant way to doing this, but it works. :-)
-	fl_str = str(fl_int)
-	as_int = int(current_temp)
-	actual_str = str(as_int)
-	if DEBUG:
-		print("get_weather_data()")
-		print("Current temp", current_temp, TEMP_SCALE)
-		print("Average temp" , average_temp , TEMP_SCALE)
-		print("Feels like", feels_like, TEMP_SCALE)
-		print("Wind speed: ", wind_speed)
-		print("Wind gusts: ", wind_gusts)
-		print("Feels like string: [", fl_str, "]")
-		print("Temperature string: [", actual_str, "]")
+	add_temp_reading(state, state.current_temp)
+	save_temp_history(state)
+	fl_str = str(int(state.feels_like))
+	actual_str = str(int(state.current_temp))
+	log.debug("get_weather_data()")
+	log.debug("Current temp %s %s", state.current_temp, TEMP_SCALE)
+	log.debug("Average temp %s %s", state.average_temp, TEMP_SCALE)
+	log.debug("Feels like %s %s", state.feels_like, TEMP_SCALE)
+	log.debug("Wind speed: %s", state.wind_speed)
+	log.debug("Wind gusts: %s", state.wind_gusts)
+	log.debug("Feels like string: [%s]", fl_str)
+	log.debug("Temperature string: [%s]", actual_str)
 
 	#
 	# If you want to play around with displaying other measurements, here are a few you can use. You can view the entire menu by pasting the wunderground
@@ -247,107 +360,140 @@ def get_weather_data():
 	#precip = TBD
 	#wind_dir = wind['deg']
 
-	actual_str = actual_str + TEMP_SCALE # remove unneeded trailing data and append temperature scale (C or F) to the end
-	feels_like_str = fl_str + TEMP_SCALE # remove unneeded trailing data and append temperature scale (C or F) to the end
-	if DEBUG:
-		print("Actual str: ", actual_str)
-		print("Feels like str: ", feels_like_str)
+	state.actual_str = actual_str + TEMP_SCALE # remove unneeded trailing data and append temperature scale (C or F) to the end
+	state.feels_like_str = fl_str + TEMP_SCALE # remove unneeded trailing data and append temperature scale (C or F) to the end
+	log.debug("Actual str: %s", state.actual_str)
+	log.debug("Feels like str: %s", state.feels_like_str)
 	return;
+#
+# The _draw_* functions below only update scrollphathd's software buffer. Pushing the buffer to the display with show()
+#	sends the whole frame over I2C, so the main loop does that exactly once per frame after all drawing is done.
+#
+
 # 
-# draw_kr_pulse(position, direction) - draws a Knight Rider-style pulsing pixel. I put this in so that I could tell that the app was running, since weather
+# _draw_kr_pulse(buf, prev_x, x) - draws a Knight Rider-style pulsing pixel. I put this in so that I could tell that the app was running, since weather
 # 	data sometimes doesn't change very frequently. Plus it's cool. In a geeky sort of way. :-)
 #
-# 	position = 1,2,3,4,5 (eg which position on the line you want to illuminate)
-#	direction = -1,1 (-1 = left, 1 = right). This is used so we know which previous pixel to turn off
+#	buf = scrollphathd's buffer (passed in so the pulse loop only has to look it up once per sweep)
+#	prev_x = x position of the pixel lit by the previous step, which gets turned off
+# 	x = x position of the pixel to illuminate on line 5
 #
-def draw_kr_pulse(pos,dir):
-	# clear 5 pixel line (easier than keeping track of where the previous illuminated pixel was)
-	scrollphathd.clear_rect(12,5,5,1)
-	x = pos + 11 #increase position to the actual x offset we need
-	scrollphathd.set_pixel(x, 5, 0.2) #turn on the current pixel
-	scrollphathd.show()
-	time.sleep(KR_PULSE_DELAY)
+# The pulse always sweeps the same 5 pixels, so the whole sweep is worked out once up front as a list of (prev_x, x) steps
+#	and each step only has to touch those two pixels.
+#
+KR_PULSE_BRIGHTNESS = 0.2
+_KR_SWEEP = (12, 13, 14, 15, 16, 15, 14, 13) #left to right, then back the other way
+_KR_STEPS = tuple(zip(_KR_SWEEP[-1:] + _KR_SWEEP[:-1], _KR_SWEEP))
+
+def _draw_kr_pulse(buf, prev_x, x, brightness=KR_PULSE_BRIGHTNESS):
+	buf[prev_x, 5] = 0 #turn off the previous pixel
+	buf[x, 5] = brightness #turn on the current pixel
 
 	return;
 #
-# draw_temp_trend(dir)
+# _draw_temp_trend(dir)
 # Draws an up arrow, down arrow, or equal sign on the rightmost 3 pixels of the display. Also show wind speed/gusts as a bar on the bottom.
 #	dir = 0 (equal), 1 (increasing), -1 (decreasing)
 #
-def draw_temp_trend(dir):
-
-	if dir == 0: #equal - don't display anything. Clear the area where direction arrow is shown
-		scrollphathd.clear_rect(14,0,3,6)
-	elif dir == 1: #increasing = up arrow. Draw an up arrow symbol on the right side of the display
-		for y in range(0,5):
-			scrollphathd.set_pixel(15,y,BRIGHT) #draw middle line of arrow
-		scrollphathd.set_pixel(14,1,BRIGHT) #draw the 'wings' of the arrow
-		scrollphathd.set_pixel(16,1,BRIGHT) 
-	elif dir == -1: #decreasing = down arrow
-		for y in range(0,5):
-			scrollphathd.set_pixel(15,y,BRIGHT) #draw middle line of arrow
-		scrollphathd.set_pixel(14,3,BRIGHT)
-		scrollphathd.set_pixel(16,3,BRIGHT)
-
+# The arrow and wind line are drawn (and cleared) straight into scrollphathd's buffer (a numpy array indexed [x, y] holding 0.0-1.0
+#	brightness values) with slice assignments instead of one set_pixel() call per pixel. Look the buffer up on every call:
+#	scrollphathd replaces it with a new array on clear() and whenever it has to grow.
+#
+# The three possible 3x6 arrow areas are drawn once up front, so showing the trend is a single copy into the buffer. They're
+#	written out as they look on the display (one row per line) and transposed to the buffer's [x, y] layout.
+#
+_TREND_ARROWS = {
+	0: numpy.zeros((3, 6)), #equal - don't display anything. Clear the area where direction arrow is shown
+	1: numpy.array([[0,1,0], #increasing = up arrow, with the 'wings' on the second line
+	                [1,1,1],
+	                [0,1,0],
+	                [0,1,0],
+	                [0,1,0],
+	                [0,0,0]]).T * BRIGHT,
+	-1: numpy.array([[0,1,0], #decreasing = down arrow
+	                 [0,1,0],
+	                 [0,1,0],
+	                 [1,1,1],
+	                 [0,1,0],
+	                 [0,0,0]]).T * BRIGHT,
+}
+
+def _draw_temp_trend(dir):
+	scrollphathd.buf[14:17, 0:6] = _TREND_ARROWS[dir]
 	return;
 
 #
-# draw_wind_line() - draws a single line indicator of wind speed and wind gusts on the bottom of the display
-# Current wind speed is shown as as bright line and gusts as as dim line. 
+# wind_line_lengths(state) - works out how many pixels of the wind line to light for the current wind speed, and where the gust
+#	indicator goes. Returns (wind_calc, gust_calc).
 #
 # Calculation: calculate a ratio (17 pixels / max wind speed) and multiply by actual wind speed, rounding
 #	to integer, yielding the number of pixels on 'x' axis to illuminate. 
- 
-def draw_wind_line():
-	global wind_speed
-	global wind_gusts
-	wind_multiplier = (17.0 / MAX_WIND_SPEED)
-	if DEBUG:
-		print("Wind multiplier: ", wind_multiplier)
-	wind_calc = wind_multiplier * wind_speed
-	if DEBUG:
-		print("wind calc: ", wind_calc)
-	wind_calc = int(wind_calc) #convert to int
-	if wind_calc > 17: #just in case something goes haywire, like a hurricane :-)
-		wind_calc = 17
-	gust_calc = wind_multiplier * wind_gusts
-	if DEBUG:
-		print("gust calc: ", gust_calc)
-	gust_calc = int(gust_calc)
-	if gust_calc > 17:
-		gust_calc = 17
-	if DEBUG:
-		print("Wind speed, calc", wind_speed, wind_calc)
-		print("wind gusts, calc", wind_gusts , gust_calc)
-	# Draw the wind speed first
-	for x in range(0,wind_calc):
-		scrollphathd.set_pixel(x, 6, WIND_BRIGHTNESS)
-	# Now draw the gust indicator as a single pixel	
+#
+def wind_line_lengths(state):
+	wind_calc = min(int(WIND_MULTIPLIER * state.wind_speed), 17) #capped just in case something goes haywire, like a hurricane :-)
+	gust_calc = min(int(WIND_MULTIPLIER * state.wind_gusts), 17)
+	log.debug("Wind speed, calc %s %s", state.wind_speed, wind_calc)
+	log.debug("wind gusts, calc %s %s", state.wind_gusts, gust_calc)
+	return wind_calc, gust_calc
+
+#
+# _draw_wind_line(wind_calc, gust_calc) - draws a single line indicator of wind speed and wind gusts on the bottom of the display
+# Current wind speed is shown as as bright line and gusts as as dim line. 
+#
+def _draw_wind_line(wind_calc, gust_calc):
+	# Redraw the whole bottom line through a view of the buffer row: clear it, draw the wind speed, then the gust indicator
+	#	as a single pixel
+	row = scrollphathd.buf[0:17, 6]
+	row[:] = 0
+	row[:wind_calc] = WIND_BRIGHTNESS
 	if gust_calc: #only draw if non zero
-		scrollphathd.set_pixel(gust_calc-1, 6, GUST_BRIGHTNESS)
+		row[gust_calc-1] = GUST_BRIGHTNESS
 	return;
 
+#
+# _render_temp_string(text) - Rasterizes a temperature string into a small sprite, laid out exactly the way
+#	scrollphathd.write_string() would draw it in font3x5 at BRIGHT brightness. Like scrollphathd's buffer, the sprite is a
+#	numpy array indexed [x, y].
+#
+def _render_temp_string(text):
+	sprite = numpy.zeros((scrollphathd.calculate_string_width(text, font3x5), font3x5.height))
+	x = 0
+	for char in text:
+		char_map = font3x5.data.get(ord(char))
+		if char_map is not None:
+			glyph = numpy.array(char_map).T * (BRIGHT / 255.0)
+			sprite[x:x + glyph.shape[0], 0:glyph.shape[1]] = glyph
+			x += glyph.shape[0] - 1
+		x += 2 #letter spacing, same as write_string()
+	return sprite
+
 #
 #
-# display_temp_value(which_temp)
+# _draw_temp_value(state, temp_str)
 #
-# This module allows the user to specify if they want actual or "feels like" temperature displayed. Feels like includes things like wind and humidity.
-# which_temp = ACTUAL or FEELS_LIKE
+# Draws the temperature string; the main loop passes the actual or "feels like" temperature depending on CURRENT_TEMP_DISPLAY.
+#	Feels like includes things like wind and humidity.
 #
-def display_temp_value():
-	global actual_str
-	global feels_like_str
+# The displayed string only changes when the whole-degree temperature does, so the last rendered sprite is kept and
+#	reused until then instead of redrawing the string glyph by glyph on every poll.
+#
+_last_temp_str = None
+_last_temp_sprite = None
+
+def _draw_temp_value(state, temp_str):
+	global _last_temp_str
+	global _last_temp_sprite
 	# clear the old temp reading. If temp > 100 then clear an extra digit's worth of pixels
-	if current_temp < 100:
-		scrollphathd.clear_rect(0, 0, 12, 5)
+	buf = scrollphathd.buf
+	if state.current_temp < 100:
+		buf[0:12, 0:5] = 0
 	else:
-		scrollphathd.clear_rect(0, 0, 17, 5)
-	if CURRENT_TEMP_DISPLAY == 1: # show actual temp
-		scrollphathd.write_string(actual_str, x = 0, y = 0, font = font3x5, brightness = BRIGHT)
-	else:	#show feels_like temp
-		scrollphathd.write_string(feels_like_str, x = 0, y = 0, font = font3x5, brightness = BRIGHT)
-	scrollphathd.show()
-	time.sleep(1)
+		buf[0:17, 0:5] = 0
+	if temp_str != _last_temp_str:
+		_last_temp_sprite = _render_temp_string(temp_str)
+		_last_temp_str = temp_str
+	width = min(_last_temp_sprite.shape[0], buf.shape[0])
+	buf[0:width, 0:5] = _last_temp_sprite[0:width]
 	return;
 
 # BEGIN MAIN LOGIC
@@ -357,42 +503,71 @@ print("Uses Raspberry Pi-W and Scrollphathd display. Written by Scott Hoge, Nove
 print("Press Ctrl-C to exit")
 print( "Current weather station: " , OWM_STATION)
 
-# Initial weather data poll and write to display
-get_weather_data()
-display_temp_value() #change this to ACTUAL at the top if you want to display actual temp instead of feels like temp
-
-draw_wind_line()
-
-#
-# Loop forever until user hits Ctrl-C
-#
-
-while True:
-	if not (int(time.time()) % POLL_INTERVAL):
-		prev_temp = current_temp
-		get_weather_data()
-		scrollphathd.clear()
-		draw_wind_line()
-		if current_temp < average_temp and (current_temp < 100 or current_temp < -9): #don't show temp trend arrow if > 100 degrees or < -10 degrees -- not enough room on the display.
-			if DEBUG:
-				print(time.asctime(time.localtime(time.time())), "Actual temp", actual_str, "Feels like temp", feels_like_str, "-")
-			draw_temp_trend(-1)
-		elif current_temp == average_temp and (current_temp < 100 or current_temp < -9):
-			if DEBUG:
-				print(time.asctime(time.localtime(time.time())), "Actual temp", actual_str, "Feels like temp", feels_like_str, "=")
-			draw_temp_trend(0)
-		elif current_temp > average_temp and (current_temp < 100 or current_temp < -9):
-			if DEBUG:
-				print(time.asctime(time.localtime(time.time())), "Actual temp", actual_str, "Feels like temp", feels_like_str, "+")
-			draw_temp_trend(1)
-		display_temp_value() #if you want actual temp, just change to ACTUAL
-
-	# Pulse a pixel, Knight Rider style, just to show that everything is alive and working. Sleeps also keep Python from consuming 100% CPU
-	# Use line 5, 14-17
-	for pulse in range(1,5):
-		draw_kr_pulse(pulse,1) #left to right
-	for pulse in range(5,1,-1):
-		draw_kr_pulse(pulse,-1) #back the other way
+setup_display()
+
+state = WeatherState()
+load_temp_history(state)
+
+# Start polling in the background. The first observation is fetched right away and drawn as soon as it arrives.
+poller = threading.Thread(target=poll_weather, name="poll_weather", daemon=True)
+poller.start()
+
+#
+# display_loop(state, poller) - Loops forever until user hits Ctrl-C, drawing each new reading from the poller as it arrives and
+#	pulsing the KR pixel in between. The pulse runs many times a second, so everything it uses is bound to a local name
+#	first: Python looks those up faster than module globals and their attributes.
+#
+def display_loop(state, poller):
+	show = scrollphathd.show
+	sleep = time.sleep
+	get_observation = _observations.get_nowait
+	draw_kr_pulse = _draw_kr_pulse
+	kr_steps = _KR_STEPS
+	kr_delay = KR_PULSE_DELAY
+	last_shown = None #(temperature string, wind line, gust indicator, trend arrow) currently in the buffer
+
+	while True:
+		try:
+			obs = get_observation()
+		except queue.Empty: #nothing new from the poller; just keep pulsing
+			if not poller.is_alive():
+				raise SystemExit("Weather polling stopped after an error; see weatherbot.log")
+		else:
+			get_weather_data(state, obs)
+			if CURRENT_TEMP_DISPLAY == 1: # show actual temp
+				temp_str = state.actual_str
+			else:	#show feels_like temp
+				temp_str = state.feels_like_str
+			wind_calc, gust_calc = wind_line_lengths(state)
+			diff = state.current_temp - state.average_temp
+			direction = 0 if abs(diff) < TEMP_TREND_TOLERANCE else (diff > 0) - (diff < 0) #1 = going up, 0 = same, -1 = going down
+			log.debug("Actual temp %s Feels like temp %s %+d", state.actual_str, state.feels_like_str, direction)
+			if -10 < state.current_temp < 100:
+				trend = direction
+			else: #don't show temp trend arrow if >= 100 degrees or <= -10 degrees -- not enough room on the display.
+				trend = None
+
+			# Conditions are often steady from one poll to the next. Only redraw if something visible has changed; otherwise
+			#	the buffer already shows exactly this.
+			shown = (temp_str, wind_calc, gust_calc, trend)
+			if shown != last_shown:
+				last_shown = shown
+				scrollphathd.clear()
+				_draw_wind_line(wind_calc, gust_calc)
+				if trend is not None:
+					_draw_temp_trend(trend)
+				_draw_temp_value(state, temp_str)
+				# no show() here; the first pulse frame below pushes the new reading to the display
+
+		# Pulse a pixel, Knight Rider style, just to show that everything is alive and working. Sleeps also keep Python from consuming 100% CPU
+		# Use line 5, 12-16
+		buf = scrollphathd.buf #drawing a new reading may have replaced the buffer, so look it up again each sweep
+		for prev_x, x in kr_steps:
+			draw_kr_pulse(buf, prev_x, x)
+			show()
+			sleep(kr_delay)
+
+display_loop(state, poller)
 
 #termination code; clear the display
 scrollphathd.clear()
@@ -15,6 +15,7 @@
 # Installation notes:
 #	# pip3 install -r requirements.txt
 #    * The scrollphat requires I2C enabled. Make sure that is turned on in raspi-config if the install above doesn't enable it.
+#    * Optionally, pip3 install orjson (or ujson if there's no orjson build for your Pi) to speed up reading the weather data.
 #
 # Note: if you want this to auto-run upon boot, add this line to the bottom of /etc/rc.local just above the "exit 0" line:
 #	sudo python3 {path}/weatherbot.py &
@@ -26,15 +27,29 @@
 
 import scrollphathd #default scrollphathd library
 from scrollphathd.fonts import font3x5
+import numpy
 import time	#returns time values
 import os
 import sys
-import getopt
+import argparse
 import logging
 import urllib3
-import socket
-import requests
 import json
+# Parse the weather data with the fastest JSON library available. All three take the raw response bytes, so there's no need
+#	to decode the body first.
+try:
+	from orjson import loads as json_loads
+except ImportError:
+	try:
+		from ujson import loads as json_loads
+	except ImportError:
+		from json import loads as json_loads
+import threading
+import queue
+import sched
+import functools
+from collections import deque
+from dataclasses import dataclass, field
 from StreamToLogger import StreamToLogger
 
 # get WEATHER_STATION from .env file
@@ -48,49 +63,56 @@ load_dotenv()
 #sys.stdout = StreamToLogger(log, logging.INFO)
 #sys.stderr = StreamToLogger(log, logging.ERROR)
 
-USAGE = f"Usage: python3 {sys.argv[0]} [-h|--help] | [-v|--version] | [-d|--debug]"
 VERSION = f"{sys.argv[0]} version 1.0.0"
 
-# Debug flag  - set to 1 if you want to print(informative console messages)
-DEBUG = 0
+# Debug messages (informative console messages) go through dprint(). It does nothing unless the -d/--debug option is given,
+#	in which case parse() points it at print() once, rather than every message checking a debug flag for itself.
+def _no_print(*args, **kwargs):
+	pass
 
-def parse():
-	global DEBUG
-
-	options, arguments = getopt.getopt(
-		sys.argv[1:],			# Arguments
-		'vhd',				# Short option definitions
-		["version", "help", "debug"])	# Long option definitions
-	for o, a in options:
-		if o in ("-v", "--version"):
-			print(VERSION)
-			sys.exit()
-		if o in ("-h", "--help"):
-			print(USAGE)
-			sys.exit()
-		if o in ("-d", "--debug"):
-			DEBUG = 1
-	if len(arguments) > 1:
-		raise SystemExit(USAGE)
-	try:
-		operands = [int(arg) for arg in arguments]
-	except ValueError:
-		raise SystemExit(USAGE)
-	return operands
+dprint = _no_print
 
-operands = parse()
-
-# Uncomment the below if your display is upside down
-#   (e.g. if you're using it in a Pimoroni Scroll Bot)
-scrollphathd.rotate(degrees=180)
+#
+# parse() - Handles the command line options (-h/--help, -v/--version and -d/--debug).
+#
+def parse():
+	global dprint
+
+	parser = argparse.ArgumentParser(description="'Live' temperature and wind display using the National Weather Service API.")
+	parser.add_argument("-v", "--version", action="version", version=VERSION)
+	parser.add_argument("-d", "--debug", action="store_true", help="print informative console messages")
+	args = parser.parse_args()
+	if args.debug:
+		dprint = print
+	return;
 
 WEATHER_STATION = os.environ.get("WEATHER_STATION","KHEF")
+OBSERVATION_URL = "https://api.weather.gov/stations/" + WEATHER_STATION + "/observations/latest"
+
+# One connection pool for the life of the script, so every poll reuses the same keep-alive connection to api.weather.gov
+#	instead of doing a fresh TCP+TLS handshake. The NWS API requires a User-Agent identifying the app, so it is set here once.
+# The pool also handles retries: a timed out or dropped request, or a "busy" reply from the server, is retried once straight away and then
+#	after 2, 4, 8 and 16 seconds, honoring any Retry-After the server sends. That all happens on the poller thread, so the display
+#	doesn't wait on it.
+HTTP_RETRIES = urllib3.Retry(total=5, backoff_factor=1.0, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET"])
+HTTP_TIMEOUT = urllib3.Timeout(connect=5.0, read=15.0)
+HTTP = urllib3.PoolManager(num_pools=1, maxsize=1, headers={"User-Agent":"(weatherbot,scott.hoge@gmail.com)"},
+	retries=HTTP_RETRIES, timeout=HTTP_TIMEOUT)
 
 # Weather polling interval (seconds). Free Wunderground API accounts allow 500 calls/day, so min interval of 172 (every ~2.88 min), assuming you're only making 1 call at a time.
 POLL_INTERVAL = 180
 
-# Interval after which the average temp is reset. Used to make sure that the temp trending indicator stays accurate. Default is 60 min.
+# Period (in minutes) the average temp is taken over. The trending indicator compares the current temp against the average of the readings
+#	from this trailing window, so it stays accurate without ever having to reset. Default is 60 min.
 AVG_TEMP_RESET_INTERVAL = 60
+TEMP_HISTORY_LENGTH = AVG_TEMP_RESET_INTERVAL*60//POLL_INTERVAL #number of polls in the window
+# The average is a running sum that picks up floating point error as readings come and go, so a current temp within this
+#	many degrees of it counts as the same (no arrow) rather than needing to match exactly.
+TEMP_TREND_TOLERANCE = 1e-6
+
+# The readings in the averaging window are saved here after every poll and read back at startup, so the trending indicator
+#	picks up where it left off after a restart instead of starting from a single reading. Or set WEATHERBOT_HISTORY_FILE.
+HISTORY_FILE = os.environ.get("WEATHERBOT_HISTORY_FILE", "/var/lib/weatherbot/history.json")
 
 # Flags used to specify whether to display actual or "feels like" temperature.
 # Change CURRENT_TEMP_DISPLAY to 1 for actual temp and anything other than 1 for feels like temperature
@@ -113,128 +135,249 @@ TEMP_SCALE = "F"
 
 # Max wind speed. Used to calculate the wind speed bar graph (17 "x" pixels / max wind speed = ratio to multiply current wind speed by in order to
 #	determine much much of a line to draw)
+#	The NWS reports temperatures in Celsius, so to_scale() converts them to the chosen scale; it's picked once here rather
+#	than checking TEMP_SCALE on every poll.
 if TEMP_SCALE == "F": #set max wind speed according to scale
 	MAX_WIND_SPEED = 75.0 #MPH; default 75.0
 	UNITS="fahrenheit"
+	def to_scale(celsius):
+		return celsius*1.8+32
 else:
 	MAX_WIND_SPEED = 100.0 #KPH; default 100.0
 	UNITS="celsius"
+	def to_scale(celsius):
+		return celsius
+WIND_MULTIPLIER = 17.0 / MAX_WIND_SPEED
+
+#
+# WeatherState - the latest readings and the strings shown for them, plus the averaging window for the trend indicator.
+#	One instance is created at startup and handed to the functions that update or draw it, instead of each of them
+#	declaring a list of globals.
+#
+@dataclass
+class WeatherState:
+	current_temp: float = 0.0
+	feels_like: float = 0.0
+	average_temp: float = 0.0
+	temp_history: deque = field(default_factory=lambda: deque(maxlen=TEMP_HISTORY_LENGTH)) #readings in the averaging window, oldest first
+	temp_history_sum: float = 0.0 #running total of temp_history, so the average doesn't have to re-add the whole window
+	wind_speed: float = 0.0
+	wind_gusts: float = 0.0
+	actual_str: str = " "
+	feels_like_str: str = " "
+
+# The station only publishes a new observation every so often, so most polls fetch the same data again. The last observation
+#	is kept along with its ETag/Last-Modified headers, which are sent back on the next poll; if nothing has changed the server
+#	answers 304 Not Modified with no body and the kept observation is reused. It's also saved to CACHE_FILE so a restart
+#	doesn't have to download it again.
+CACHE_FILE = os.environ.get("WEATHERBOT_CACHE_FILE", "/tmp/weatherbot_cache.json")
+cached_cond = None #last observation received, already parsed
+cached_validators = {} #If-None-Match/If-Modified-Since headers to send with the next poll
 
-#Initialize global variables before use
-current_temp = 0.0
-average_temp = 0.0
-wind_chill = 0.0
-average_temp_counter = 0
-average_temp_cumulative = 0.0
-total_poll_time = 0 #used to reset the average temp after a defined amount of time has passed
-wind_speed = 0.0
-wind_gusts = 0
-actual_str = " "
-feels_like_str = " "
-feels_like = 0
-
-#
-# get_weather_data() - Retrieves and parses the weather data we want to display from Wunderground. Returns a formatted temperature string
-#	using the specified scale. To request a free API key, go here: https://www.wunderground.com/weather/api/d/pricing.html
-#
-
-def get_weather_data():
-	# Make sure that the module updates the global variables instead of creating local copies
-	global current_temp
-	global average_temp_cumulative
-
-	global average_temp_counter
-	global average_temp
-	global wind_speed
-	global wind_gusts
-	global current_str
-	global actual_str
-	global feels_like_str
-	global feels_like
-
-	http = urllib3.PoolManager()
-
-	#Get current conditions. 
-	trycount = 0
-	url = "https://api.weather.gov/stations/" + WEATHER_STATION + "/observations/latest"
+#
+# load_temp_history(state) - Reloads the readings saved by save_temp_history() into the averaging window. They're skipped if
+#	they were saved longer ago than the averaging period (they'd say nothing about the current trend) or in the other
+#	temperature scale.
+#
+def load_temp_history(state):
 	try:
-		conditions = http.request("GET",url,headers={"User-Agent":"(weatherbot,scott.hoge@gmail.com)"})
-	except (urllib3.exceptions.ReadTimeoutError, socket.timeout, requests.exceptions.ReadTimeout):
-		print("TIMEOUT ERROR: ", sys.exc_info()[0])
-		trycount += 1
-		time.sleep(10)
-	except e:
-		raise(e)
+		with open(HISTORY_FILE) as f:
+			history = json.load(f)
+		if time.time() - history['saved'] > AVG_TEMP_RESET_INTERVAL*60 or history['scale'] != TEMP_SCALE:
+			return;
+		temps = [float(temp) for temp in history['temps']] #check them all before adding any
+	except FileNotFoundError:
+		return;
+	except (OSError, ValueError, KeyError, TypeError) as e:
+		print("Couldn't read temperature history: ", e)
+		return;
+	state.temp_history.extend(temps)
+	if state.temp_history:
+		state.temp_history_sum = sum(state.temp_history)
+		state.average_temp = state.temp_history_sum / len(state.temp_history)
+	return;
 
-	if trycount > 0:
-		print(f'Took {trycount} retries to get weather.')
+#
+# save_temp_history(state) - Saves the readings in the averaging window to HISTORY_FILE. It's written to a temporary file
+#	first and then renamed over the old one, so losing power part way through can't leave a half-written history behind.
+#
+def save_temp_history(state):
+	try:
+		os.makedirs(os.path.dirname(HISTORY_FILE), exist_ok=True)
+		with open(HISTORY_FILE + ".tmp", "w") as f:
+			json.dump({'saved': time.time(), 'scale': TEMP_SCALE, 'temps': list(state.temp_history)}, f)
+		os.replace(HISTORY_FILE + ".tmp", HISTORY_FILE)
+	except OSError as e:
+		print("Couldn't save temperature history: ", e)
+	return;
 
-	parsed_cond = json.loads(conditions.data.decode('utf-8'))
-	conditions.close()
+#
+# load_cache() - Reloads the observation saved by a previous run, if there is one. A missing or unreadable cache file, or one
+#	saved for a different station, just means the first poll downloads the observation in full.
+#
+def load_cache():
+	global cached_cond
+	global cached_validators
 
-	#build current temperature string
+	try:
+		with open(CACHE_FILE) as f:
+			cache = json.load(f)
+		if cache['url'] == OBSERVATION_URL and isinstance(cache['validators'], dict) and isinstance(cache['observation'], dict): #otherwise it's for another station, or mangled
+			cached_cond = cache['observation']
+			cached_validators = cache['validators']
+	except (OSError, ValueError, KeyError, TypeError):
+		cached_cond = None
+		cached_validators = {}
+	return;
 
-	# Check to see if average temp counters need to be reset
-	if (average_temp_counter * POLL_INTERVAL / 60) > AVG_TEMP_RESET_INTERVAL:
-		average_temp_cumulative = 0.0
-		average_temp_counter = 0
-		if DEBUG:
-			print("Resetting average temp counters")
+#
+# save_cache() - Saves the last observation and its validators to CACHE_FILE, along with the URL they came from. It's written
+#	the same way as the temperature history, through a temporary file. Failing to save isn't fatal; the cache is only
+#	an optimization.
+#
+def save_cache():
+	try:
+		with open(CACHE_FILE + ".tmp", "w") as f:
+			json.dump({'url': OBSERVATION_URL, 'validators': cached_validators, 'observation': cached_cond}, f)
+		os.replace(CACHE_FILE + ".tmp", CACHE_FILE)
+	except OSError as e:
+		print("Couldn't save observation cache: ", e)
+	return;
 
-	# parse out the current temperature and wind speeds from the json catalog based on which temperature scale is being used
-	temperature = str(1.8*(parsed_cond['properties']['temperature']['value'])+32)
-	current_temp = (1.8*(parsed_cond['properties']['temperature']['value'])+32)
-	#feels_like = float(temp['feels_like'])
+#
+# fetch_conditions() - Retrieves the latest observation for WEATHER_STATION from the NWS API and returns it parsed, or None
+#	if the API couldn't be reached. Runs on the poller thread, so it only touches the observation cache, never the display.
+#
+
+def fetch_conditions():
+	global cached_cond
+	global cached_validators
+
+	#Get current conditions. If that fails, keep showing the last reading until the next poll
+	try:
+		conditions = HTTP.request("GET",OBSERVATION_URL,headers={**HTTP.headers, **cached_validators}) #passing headers replaces the pool's, so keep the User-Agent
+	except urllib3.exceptions.HTTPError as e: #MaxRetryError once the retries run out, or anything else urllib3 can't recover from
+		print("Couldn't get weather: ", e)
+		return None
+
+	if conditions.status == 304 and cached_cond is not None: #nothing new since the last poll
+		parsed_cond = cached_cond
+		dprint("Observation not modified since last poll")
+	elif conditions.status == 200:
+		try:
+			parsed_cond = json_loads(conditions.data) #reading the body hands the connection back to the pool
+		except ValueError as e: #all three JSON libraries raise a ValueError subclass for a garbled body
+			print("Couldn't parse weather: ", e)
+			return None
+		cached_cond = parsed_cond
+		cached_validators = {}
+		if 'ETag' in conditions.headers:
+			cached_validators['If-None-Match'] = conditions.headers['ETag']
+		if 'Last-Modified' in conditions.headers:
+			cached_validators['If-Modified-Since'] = conditions.headers['Last-Modified']
+		save_cache()
+	elif conditions.status == 304: #validators with no observation to go with them; drop them so the next poll gets it in full
+		cached_validators = {}
+		print("Couldn't get weather: not modified, but no observation kept")
+		return None
+	else: #e.g. 404 for an unknown station
+		print("Couldn't get weather: HTTP status", conditions.status)
+		return None
+	return parsed_cond
+
+#
+# poll_weather() - Runs on a background thread, fetching the latest observation every POLL_INTERVAL seconds and handing it
+#	to the main loop through the _conditions queue. Keeping the network I/O here means a slow fetch never freezes the KR pulse.
+#	If anything unexpected goes wrong in here the thread ends with a traceback, and the main loop exits rather than pulsing
+#	away as if all was well while the reading never changes again.
+#
+
+_conditions = queue.Queue(maxsize=1)
+
+def poll_weather():
+	# Each poll books the next one at an absolute time on the monotonic clock, so the time spent fetching doesn't push the
+	#	schedule later and wall clock changes (NTP, DST) don't shift it. Between polls the thread just sleeps in the scheduler.
+	scheduler = sched.scheduler(time.monotonic, time.sleep)
 
-	#wind = obs.wind(unit='miles_hour')
-	wind_speed = float(parsed_cond['properties']['windSpeed']['value'])
-	wind_gusts = float(parsed_cond['properties']['windGust']['value'])
+	def poll(due):
+		parsed_cond = fetch_conditions()
+		if parsed_cond is not None:
+			_conditions.put(parsed_cond)
+		# If the fetch ran past the next slot (retries on a bad connection, say), poll again straight away rather than
+		#	trying to catch up on the polls that were missed
+		due = max(due + POLL_INTERVAL, time.monotonic())
+		scheduler.enterabs(due, 1, poll, (due,))
+
+	now = time.monotonic()
+	scheduler.enterabs(now, 1, poll, (now,))
+	scheduler.run()
+
+#
+# get_weather_data(state, parsed_cond) - Parses the weather data we want to display out of an NWS observation and updates the
+#	temperature and wind readings in state, including the formatted temperature strings using the specified scale.
+#	Returns False, leaving state as it was, if the observation has no temperature in it; the NWS reports missing readings as
+#	null, e.g. while a station's instruments are down.
+#
+
+def get_weather_data(state, parsed_cond):
+	#build current temperature string
+
+	# parse out the current temperature and wind speeds from the json catalog based on which temperature scale is being used
+	props = parsed_cond['properties']
+	if (temp := props['temperature']['value']) is None: #nothing new to show; keep the last reading on the display
+		dprint("No temperature in this observation")
+		return False
+	state.current_temp = current_temp = to_scale(temp)
+	if (wind_speed := props['windSpeed']['value']) is not None: #otherwise keep the last wind speed
+		state.wind_speed = float(wind_speed)
+	state.wind_gusts = float(props['windGust']['value'] or 0.0) #null whenever the station hasn't recorded any gusts
 	
 	# Calculate average temperature, which is used to determine temperature trending (same, up, down)
-	average_temp_cumulative = average_temp_cumulative + current_temp
-	average_temp_counter = average_temp_counter + 1
-	average_temp = average_temp_cumulative / average_temp_counter
-	fl_int = int(feels_like) #convert to integer from float. For some reason you can't cast the above directly as an int, so need to take an extra step. I'm sure there is a more elegant way to doing this, but it works. :-)
+	temp_history = state.temp_history
+	if len(temp_history) == temp_history.maxlen:
+		state.temp_history_sum -= temp_history[0] #about to be pushed out by the append below
+	temp_history.append(current_temp)
+	state.temp_history_sum += current_temp
+	state.average_temp = state.temp_history_sum / len(temp_history)
+	save_temp_history(state)
+	fl_int = int(state.feels_like) #convert to integer from float. For some reason you can't cast the above directly as an int, so need to take an extra step. I'm sure there is a more elegant way to doing this, but it works. :-)
 	fl_str = str(fl_int)
 	as_int = int(current_temp)
 	actual_str = str(as_int)
-	if DEBUG:
-		print("get_weather_data()")
-		print("Current temp", current_temp, TEMP_SCALE)
-		print("Average temp" , average_temp , TEMP_SCALE)
-		print("Feels like", feels_like, TEMP_SCALE)
-		print("Wind speed: ", wind_speed)
-		print("Wind gusts: ", wind_gusts)
-		print("Feels like string: [", fl_str, "]")
-		print("Temperature string: [", actual_str, "]")
-
-	#
-	# If you want to play around with displaying other measurements, here are a few you can use. You can view the entire menu by pasting the wunderground
-	#	URL above into a web browser, which will return the raw json output. 
-	#
-
-	#humidity = temp['humidity']
-	#precip = TBD
-	#wind_dir = wind['deg']
-
-	actual_str = actual_str + TEMP_SCALE # remove unneeded trailing data and append temperature scale (C or F) to the end
-	feels_like_str = fl_str + TEMP_SCALE # remove unneeded trailing data and append temperature scale (C or F) to the end
-	if DEBUG:
-		print("Actual str: ", actual_str)
-		print("Feels like str: ", feels_like_str)
-	return;
+	dprint("get_weather_data()")
+	dprint("Current temp", state.current_temp, TEMP_SCALE)
+	dprint("Average temp" , state.average_temp , TEMP_SCALE)
+	dprint("Feels like", state.feels_like, TEMP_SCALE)
+	dprint("Wind speed: ", state.wind_speed)
+	dprint("Wind gusts: ", state.wind_gusts)
+	dprint("Feels like string: [", fl_str, "]")
+	dprint("Temperature string: [", actual_str, "]")
+
+	state.actual_str = actual_str + TEMP_SCALE # remove unneeded trailing data and append temperature scale (C or F) to the end
+	state.feels_like_str = fl_str + TEMP_SCALE # remove unneeded trailing data and append temperature scale (C or F) to the end
+	dprint("Actual str: ", state.actual_str)
+	dprint("Feels like str: ", state.feels_like_str)
+	return True
 # 
-# draw_kr_pulse(position, direction) - draws a Knight Rider-style pulsing pixel. I put this in so that I could tell that the app was running, since weather
+# draw_kr_pulse(position) - draws a Knight Rider-style pulsing pixel. I put this in so that I could tell that the app was running, since weather
 # 	data sometimes doesn't change very frequently. Plus it's cool. In a geeky sort of way. :-)
 #
 # 	position = 1,2,3,4,5 (eg which position on the line you want to illuminate)
-#	direction = -1,1 (-1 = left, 1 = right). This is used so we know which previous pixel to turn off
 #
-def draw_kr_pulse(pos,dir):
-	# clear 5 pixel line (easier than keeping track of where the previous illuminated pixel was)
-	scrollphathd.clear_rect(12,5,5,1)
+# Only the pixel lit by the previous call is turned off, written straight into the display buffer, instead of clearing the whole
+#	5 pixel line and going through set_pixel() each frame. KR_SWEEP is the order the positions are lit in for one full sweep.
+#
+KR_SWEEP = (1, 2, 3, 4, 5, 4, 3, 2) #left to right, then back the other way
+kr_prev_x = 12 #x offset of the pixel lit last time
+
+def draw_kr_pulse(pos):
+	global kr_prev_x
+
 	x = pos + 11 #increase position to the actual x offset we need
-	scrollphathd.set_pixel(x, 5, 0.2) #turn on the current pixel
+	buf = scrollphathd.buf #replaced on every clear(), so don't hang on to it
+	buf[kr_prev_x, 5] = 0 #turn off the previous pixel
+	buf[x, 5] = 0.2 #turn on the current pixel
+	kr_prev_x = x
 	scrollphathd.show()
 	time.sleep(KR_PULSE_DELAY)
 
@@ -244,127 +387,177 @@ def draw_kr_pulse(pos,dir):
 # Draws an up arrow, down arrow, or equal sign on the rightmost 3 pixels of the display. Also show wind speed/gusts as a bar on the bottom.
 #	dir = 0 (equal), 1 (increasing), -1 (decreasing)
 #
-def draw_temp_trend(dir):
-
-	if dir == 0: #equal - don't display anything. Clear the area where direction arrow is shown
-		scrollphathd.clear_rect(14,0,3,6)
-	elif dir == 1: #increasing = up arrow. Draw an up arrow symbol on the right side of the display
-		for y in range(0,5):
-			scrollphathd.set_pixel(15,y,BRIGHT) #draw middle line of arrow
-		scrollphathd.set_pixel(14,1,BRIGHT) #draw the 'wings' of the arrow
-		scrollphathd.set_pixel(16,1,BRIGHT) 
-	elif dir == -1: #decreasing = down arrow
-		for y in range(0,5):
-			scrollphathd.set_pixel(15,y,BRIGHT) #draw middle line of arrow
-		scrollphathd.set_pixel(14,3,BRIGHT)
-		scrollphathd.set_pixel(16,3,BRIGHT)
+# Each arrow is a ready-made 3x6 block of brightness values that gets copied over the arrow area of scrollphathd.buf in one go,
+#	rather than lighting it a pixel at a time. The blocks are written the way they look on the display and then transposed,
+#	since the buffer is indexed [x, y]. scrollphathd swaps in a new buffer on clear(), so it's looked up each time.
+#
+TREND_ARROWS = {
+	0: numpy.zeros((3, 6)), #equal - don't display anything. Clear the area where direction arrow is shown
+	1: numpy.array([[0,1,0], #increasing = up arrow; middle line plus the 'wings' one pixel down from the top
+	                [1,1,1],
+	                [0,1,0],
+	                [0,1,0],
+	                [0,1,0],
+	                [0,0,0]]).T * BRIGHT,
+	-1: numpy.array([[0,1,0], #decreasing = down arrow
+	                 [0,1,0],
+	                 [0,1,0],
+	                 [1,1,1],
+	                 [0,1,0],
+	                 [0,0,0]]).T * BRIGHT,
+}
 
+def draw_temp_trend(dir):
+	scrollphathd.buf[14:17, 0:6] = TREND_ARROWS[dir]
 	return;
 
 #
-# draw_wind_line() - draws a single line indicator of wind speed and wind gusts on the bottom of the display
+# draw_wind_line(state) - draws a single line indicator of wind speed and wind gusts on the bottom of the display
 # Current wind speed is shown as as bright line and gusts as as dim line. 
 #
 # Calculation: calculate a ratio (17 pixels / max wind speed) and multiply by actual wind speed, rounding
 #	to integer, yielding the number of pixels on 'x' axis to illuminate. 
- 
-def draw_wind_line():
-	global wind_speed
-	global wind_gusts
-	wind_multiplier = (17.0 / MAX_WIND_SPEED)
-	if DEBUG:
-		print("Wind multiplier: ", wind_multiplier)
-	wind_calc = wind_multiplier * wind_speed
-	if DEBUG:
-		print("wind calc: ", wind_calc)
+#
+# The line only moves when the wind changes by a whole pixel's worth, so if it comes out the same as last time, the row
+#	already on the display is left as it is.
+#
+last_wind_line = None #(wind_calc, gust_calc) currently on the display
+
+def draw_wind_line(state):
+	global last_wind_line
+	wind_speed = state.wind_speed
+	wind_gusts = state.wind_gusts
+	wind_calc = WIND_MULTIPLIER * wind_speed
+	dprint("wind calc: ", wind_calc)
 	wind_calc = int(wind_calc) #convert to int
 	if wind_calc > 17: #just in case something goes haywire, like a hurricane :-)
 		wind_calc = 17
-	gust_calc = wind_multiplier * wind_gusts
-	if DEBUG:
-		print("gust calc: ", gust_calc)
+	gust_calc = WIND_MULTIPLIER * wind_gusts
+	dprint("gust calc: ", gust_calc)
 	gust_calc = int(gust_calc)
 	if gust_calc > 17:
 		gust_calc = 17
-	if DEBUG:
-		print("Wind speed, calc", wind_speed, wind_calc)
-		print("wind gusts, calc", wind_gusts , gust_calc)
-	# Draw the wind speed first
-	for x in range(0,wind_calc):
-		scrollphathd.set_pixel(x, 6, WIND_BRIGHTNESS)
+	dprint("Wind speed, calc", wind_speed, wind_calc)
+	dprint("wind gusts, calc", wind_gusts , gust_calc)
+	if (wind_calc, gust_calc) == last_wind_line:
+		return;
+	last_wind_line = (wind_calc, gust_calc)
+	# Draw the wind speed first, straight into the bottom row of the display buffer (indexed [x, y]). The rest of the display
+	#	isn't cleared between polls, so clear the old line first.
+	row = scrollphathd.buf[0:17, 6]
+	row[:] = 0
+	row[:wind_calc] = WIND_BRIGHTNESS
 	# Now draw the gust indicator as a single pixel	
 	if gust_calc: #only draw if non zero
-		scrollphathd.set_pixel(gust_calc-1, 6, GUST_BRIGHTNESS)
+		row[gust_calc-1] = GUST_BRIGHTNESS
 	return;
 
+#
+# render_temp(text) - Rasterizes a temperature string in font3x5 at BRIGHT brightness into a numpy array indexed [x, y], pixel for
+#	pixel the way write_string() would draw it. There are only a couple of hundred temperature strings the display will ever
+#	show, so each is only rendered once and then looked up. The cached arrays are shared, so copy from them, never into them.
+#
+@functools.lru_cache(maxsize=256)
+def render_temp(text):
+	sprite = numpy.zeros((scrollphathd.calculate_string_width(text, font3x5), font3x5.height))
+	x = 0
+	for char in text:
+		char_map = font3x5.data.get(ord(char))
+		if char_map is not None:
+			glyph = numpy.array(char_map).T * (BRIGHT / 255.0)
+			sprite[x:x + glyph.shape[0], 0:glyph.shape[1]] = glyph
+			x += glyph.shape[0] - 1
+		x += 2 #letter spacing, same as write_string()
+	return sprite
+
 #
 #
-# display_temp_value(which_temp)
+# display_temp_value(state)
 #
 # This module allows the user to specify if they want actual or "feels like" temperature displayed. Feels like includes things like wind and humidity.
 # which_temp = ACTUAL or FEELS_LIKE
 #
-def display_temp_value():
-	global actual_str
-	global feels_like_str
-	# clear the old temp reading. If temp > 100 then clear an extra digit's worth of pixels
-	if current_temp < 100:
-		scrollphathd.clear_rect(0, 0, 12, 5)
-	else:
-		scrollphathd.clear_rect(0, 0, 17, 5)
+# Only whole degrees are shown, so the string only changes a few times an hour. Until it does, the reading already on the display
+#	is left alone rather than being cleared, redrawn and sent to the display again.
+#
+last_temp_str = None #temperature string currently on the display
+
+def display_temp_value(state):
+	global last_temp_str
 	if CURRENT_TEMP_DISPLAY == 1: # show actual temp
-		scrollphathd.write_string(actual_str, x = 0, y = 0, font = font3x5, brightness = BRIGHT)
+		temp_str = state.actual_str
 	else:	#show feels_like temp
-		scrollphathd.write_string(feels_like_str, x = 0, y = 0, font = font3x5, brightness = BRIGHT)
-	scrollphathd.show()
-	time.sleep(1)
+		temp_str = state.feels_like_str
+	if temp_str == last_temp_str:
+		return;
+	last_temp_str = temp_str
+	# clear the old temp reading, all the way across in case it was wide enough to run into the trend arrow area, and copy in the new one
+	buf = scrollphathd.buf
+	buf[0:17, 0:5] = 0
+	sprite = render_temp(temp_str)
+	width = min(sprite.shape[0], 17)
+	buf[0:width, 0:5] = sprite[0:width]
+	# no show() here; the next KR pulse frame sends the new reading to the display along with the trend arrow drawn after it
 	return;
 
 # BEGIN MAIN LOGIC
+#
+# main() - Everything that touches the display or the network happens from here, so the script can be imported (e.g. to try out
+#	one of the functions above) without taking over the display.
+#
+def main():
+	parse()
+
+	# Uncomment the below if your display is upside down
+	#   (e.g. if you're using it in a Pimoroni Scroll Bot)
+	scrollphathd.rotate(degrees=180)
+
+	print("'Live' temperature and wind display using National Weather Service API.")
+	print("Uses Raspberry Pi-W and Scrollphathd display. Written by Scott Hoge, November 2021")
+	print("Press Ctrl-C to exit")
+	print( "Current weather station: " , WEATHER_STATION)
+
+	# Start polling the weather in the background. The first observation is fetched straight away and drawn by the loop below.
+	state = WeatherState()
+	load_temp_history(state)
+	load_cache()
+	poller = threading.Thread(target=poll_weather, name="poll_weather", daemon=True)
+	poller.start()
+
+	#
+	# Loop forever until user hits Ctrl-C
+	#
+
+	while True:
+		try:
+			parsed_cond = _conditions.get_nowait()
+		except queue.Empty: #nothing new from the poller; just keep pulsing
+			if not poller.is_alive():
+				raise SystemExit("Weather polling stopped after an error; see the traceback above")
+		else:
+			if get_weather_data(state, parsed_cond): #False if the observation had no temperature; the display keeps the last reading
+				draw_wind_line(state)
+				display_temp_value(state) #drawn before the trend arrow, since a new reading clears the full width of the display
+				diff = state.current_temp - state.average_temp
+				if diff <= -TEMP_TREND_TOLERANCE and -10 < state.current_temp < 100: #don't show temp trend arrow if >= 100 degrees or <= -10 degrees -- not enough room on the display.
+					dprint(time.asctime(time.localtime(time.time())), "Actual temp", state.actual_str, "Feels like temp", state.feels_like_str, "-")
+					draw_temp_trend(-1)
+				elif abs(diff) < TEMP_TREND_TOLERANCE and -10 < state.current_temp < 100:
+					dprint(time.asctime(time.localtime(time.time())), "Actual temp", state.actual_str, "Feels like temp", state.feels_like_str, "=")
+					draw_temp_trend(0)
+				elif diff >= TEMP_TREND_TOLERANCE and -10 < state.current_temp < 100:
+					dprint(time.asctime(time.localtime(time.time())), "Actual temp", state.actual_str, "Feels like temp", state.feels_like_str, "+")
+					draw_temp_trend(1)
+
+		# Pulse a pixel, Knight Rider style, just to show that everything is alive and working. Sleeps also keep Python from consuming 100% CPU
+		# Use line 5, 12-16
+		for pulse in KR_SWEEP:
+			draw_kr_pulse(pulse)
+
+	#termination code; clear the display
+	scrollphathd.clear()
+	scrollphathd.show()
+	print("Exiting....")
 
-print("'Live' temperature and wind display using National Weather Service API.")
-print("Uses Raspberry Pi-W and Scrollphathd display. Written by Scott Hoge, November 2021")
-print("Press Ctrl-C to exit")
-print( "Current weather station: " , WEATHER_STATION)
-
-# Initial weather data poll and write to display
-get_weather_data()
-display_temp_value() #change this to ACTUAL at the top if you want to display actual temp instead of feels like temp
-
-draw_wind_line()
-
-#
-# Loop forever until user hits Ctrl-C
-#
-
-while True:
-	if not (int(time.time()) % POLL_INTERVAL):
-		prev_temp = current_temp
-		get_weather_data()
-		scrollphathd.clear()
-		draw_wind_line()
-		if current_temp < average_temp and (current_temp < 100 or current_temp < -9): #don't show temp trend arrow if > 100 degrees or < -10 degrees -- not enough room on the display.
-			if DEBUG:
-				print(time.asctime(time.localtime(time.time())), "Actual temp", actual_str, "Feels like temp", feels_like_str, "-")
-			draw_temp_trend(-1)
-		elif current_temp == average_temp and (current_temp < 100 or current_temp < -9):
-			if DEBUG:
-				print(time.asctime(time.localtime(time.time())), "Actual temp", actual_str, "Feels like temp", feels_like_str, "=")
-			draw_temp_trend(0)
-		elif current_temp > average_temp and (current_temp < 100 or current_temp < -9):
-			if DEBUG:
-				print(time.asctime(time.localtime(time.time())), "Actual temp", actual_str, "Feels like temp", feels_like_str, "+")
-			draw_temp_trend(1)
-		display_temp_value() #if you want actual temp, just change to ACTUAL
-
-	# Pulse a pixel, Knight Rider style, just to show that everything is alive and working. Sleeps also keep Python from consuming 100% CPU
-	# Use line 5, 14-17
-	for pulse in range(1,5):
-		draw_kr_pulse(pulse,1) #left to right
-	for pulse in range(5,1,-1):
-		draw_kr_pulse(pulse,-1) #back the other way
-
-#termination code; clear the display
-scrollphathd.clear()
-scrollphathd.show()
-print("Exiting....")
+if __name__ == '__main__':
+	main()